@@ -63,6 +63,10 @@ class SaveClassImages(Callback):
         batch = state.batch
         for i, image in enumerate(images):
             image = F.to_pil_image(image)
-            hash_image = hashlib.sha1(image.tobytes()).hexdigest()
+            # the hash only disambiguates filenames across runs (the index
+            # already makes them unique within a run), a 64-bit blake2b
+            # digest is plenty and hashes less state than a full digest
+            hash_image = hashlib.blake2b(image.tobytes(),
+                                         digest_size=8).hexdigest()
             image_filename = self.class_images_dir / f"{batch['index'][i] + self.cur_class_images}-{hash_image}.jpg"
             image.save(image_filename)
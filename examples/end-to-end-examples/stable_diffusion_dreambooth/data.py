@@ -39,6 +39,31 @@ def dreambooth_collate_fn(examples: dict, use_prior_preservation: bool = False):
     return batch
 
 
+def cached_dreambooth_collate_fn(examples: dict,
+                                 use_prior_preservation: bool = False):
+    latents_mean = [example['instance_latents_mean'] for example in examples]
+    latents_logvar = [
+        example['instance_latents_logvar'] for example in examples
+    ]
+    text_embeds = [example['instance_text_embeds'] for example in examples]
+
+    # Concat class and instance examples for prior preservation.
+    # We do this to avoid doing two forward passes.
+    if use_prior_preservation:
+        latents_mean += [example['class_latents_mean'] for example in examples]
+        latents_logvar += [
+            example['class_latents_logvar'] for example in examples
+        ]
+        text_embeds += [example['class_text_embeds'] for example in examples]
+
+    batch = {
+        'latents_mean': torch.stack(latents_mean),
+        'latents_logvar': torch.stack(latents_logvar),
+        'text_embeds': torch.stack(text_embeds),
+    }
+    return batch
+
+
 def build_dreambooth_dataloader(instance_data_root: str,
                                 instance_prompt: str,
                                 tokenizer: transformers.PreTrainedTokenizer,
@@ -47,6 +72,8 @@ def build_dreambooth_dataloader(instance_data_root: str,
                                 center_crop: Optional[bool] = False,
                                 class_prompt: Optional[str] = None,
                                 class_data_root: Optional[str] = None,
+                                vae: Optional[torch.nn.Module] = None,
+                                text_encoder: Optional[torch.nn.Module] = None,
                                 *,
                                 batch_size: int,
                                 drop_last: Optional[bool] = True,
@@ -70,6 +97,11 @@ def build_dreambooth_dataloader(instance_data_root: str,
         class_prompt (str): Prompt associate with prior presevation images. Default: `None`.
         class_data_root (str): Path the image generated from the model for prior preservation.
             Default: `None`.
+        vae (torch.nn.Module): Frozen vae used to pre-encode the images to
+            latents once, instead of re-encoding every training step. Must be
+            given together with `text_encoder`. Default: `None`.
+        text_encoder (torch.nn.Module): Frozen text encoder used to pre-encode
+            the prompts. Must be given together with `vae`. Default: `None`.
         batch_size (int): Batch size per device.
         drop_last (bool): Whether to drop last samples. Default: ``True``.
         shuffle (bool): Whether to shuffle the dataset. Default: ``True``.
@@ -93,13 +125,20 @@ def build_dreambooth_dataloader(instance_data_root: str,
                                 class_prompt=class_prompt,
                                 tokenizer=tokenizer,
                                 image_transforms=image_transforms)
+    use_prior_preservation = True if class_prompt and class_data_root else False
+    if vae is not None and text_encoder is not None:
+        dataset = CachedDreamBoothDataset(dataset,
+                                          vae=vae,
+                                          text_encoder=text_encoder)
+        collate_fn = partial(cached_dreambooth_collate_fn,
+                             use_prior_preservation=use_prior_preservation)
+    else:
+        collate_fn = partial(dreambooth_collate_fn,
+                             use_prior_preservation=use_prior_preservation)
     sampler = dist.get_sampler(
         dataset,
         drop_last=drop_last,  # type: ignore
         shuffle=shuffle)  # type: ignore
-    use_prior_preservation = True if class_prompt and class_data_root else False
-    collate_fn = partial(dreambooth_collate_fn,
-                         use_prior_preservation=use_prior_preservation)
     return DataLoader(
         dataset=dataset,
         batch_size=batch_size,
@@ -231,3 +270,80 @@ class DreamBoothDataset(Dataset):
                 return_tensors='pt',
             ).input_ids
         return example
+
+
+class CachedDreamBoothDataset(Dataset):
+    """Dreambooth dataset with pre-encoded latents and text embeddings.
+
+    The vae and text encoder are frozen during dreambooth training, so their
+    outputs are deterministic functions of the (tiny) instance/class image set
+    and the two fixed prompts. This dataset runs both frozen encoders once at
+    construction time and serves the cached results, removing the two largest
+    non-unet forward passes from every training step. The latent distribution
+    mean and logvar are stored so latents can still be sampled each step.
+
+    Note: pre-encoding fixes the image crop, so the random-crop augmentation
+    from `build_dreambooth_dataloader(center_crop=False)` only applies once.
+
+    Args:
+        dataset (DreamBoothDataset): Dataset to pre-encode.
+        vae (torch.nn.Module): Frozen vae, must support `.encode()`.
+        text_encoder (torch.nn.Module): Frozen text encoder.
+    """
+
+    def __init__(self, dataset: DreamBoothDataset, vae: torch.nn.Module,
+                 text_encoder: torch.nn.Module):
+        self.dataset = dataset
+        device = next(vae.parameters()).device
+        dtype = next(vae.parameters()).dtype
+
+        @torch.no_grad()
+        def encode_image(image: torch.Tensor):
+            latent_dist = vae.encode(
+                image.unsqueeze(0).to(device=device,
+                                      dtype=dtype))['latent_dist']
+            return (latent_dist.mean.squeeze(0).float().cpu(),
+                    latent_dist.logvar.squeeze(0).float().cpu())
+
+        @torch.no_grad()
+        def encode_prompt(input_ids: torch.Tensor):
+            return text_encoder(
+                input_ids.to(device))[0].squeeze(0).float().cpu()
+
+        self.instance_latents = []
+        self.class_latents = []
+        self.instance_text_embeds = None
+        self.class_text_embeds = None
+        # only encode each unique image once, `DreamBoothDataset.__getitem__`
+        # wraps around the shorter of the instance/class image sets.
+        for index in range(len(dataset)):
+            example = dataset[index]
+            if index < dataset.num_instance_images:
+                self.instance_latents.append(
+                    encode_image(example['instance_images']))
+            if self.instance_text_embeds is None:
+                self.instance_text_embeds = encode_prompt(
+                    example['instance_prompt_ids'])
+            if dataset.class_data_root:
+                if index < dataset.num_class_images:
+                    self.class_latents.append(
+                        encode_image(example['class_images']))
+                if self.class_text_embeds is None:
+                    self.class_text_embeds = encode_prompt(
+                        example['class_prompt_ids'])
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index: int):
+        example = {}
+        mean, logvar = self.instance_latents[index % len(self.instance_latents)]
+        example['instance_latents_mean'] = mean
+        example['instance_latents_logvar'] = logvar
+        example['instance_text_embeds'] = self.instance_text_embeds
+        if self.class_latents:
+            mean, logvar = self.class_latents[index % len(self.class_latents)]
+            example['class_latents_mean'] = mean
+            example['class_latents_logvar'] = logvar
+            example['class_text_embeds'] = self.class_text_embeds
+        return example
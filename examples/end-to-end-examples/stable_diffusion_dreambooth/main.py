@@ -21,6 +21,19 @@ from omegaconf import DictConfig, OmegaConf
 
 def main(config: DictConfig):  # type: ignore
     reproducibility.seed_all(config.seed)
+
+    if config.device == 'gpu':
+        # input shapes are fixed, let cudnn pick the fastest conv algorithms
+        torch.backends.cudnn.benchmark = True
+        if hasattr(torch, 'set_float32_matmul_precision'):
+            # run residual fp32 matmuls on tensor cores via TF32 (Ampere+)
+            torch.set_float32_matmul_precision('high')
+        if hasattr(torch.backends.cuda, 'enable_flash_sdp'):
+            # prefer the fused SDPA backends; the math fallback stays enabled
+            # for shapes the fused kernels don't support
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+
     # initialize the pytorch distributed process group if training on multiple gpus.
 
     if dist.get_world_size() != 0 and config.device == 'gpu':
@@ -42,7 +55,10 @@ def main(config: DictConfig):  # type: ignore
         num_images_per_prompt=config.model.num_images_per_prompt,
         image_key=config.model.image_key,
         caption_key=config.model.caption_key,
-        prior_loss_weight=config.get('prior_loss_weight', 1.0))
+        prior_loss_weight=config.get('prior_loss_weight', 1.0),
+        torch_compile=config.model.get('torch_compile', False),
+        fp16_frozen_weights=config.model.get('fp16_frozen_weights', False),
+        inference_backend=config.model.get('inference_backend', 'pytorch'))
 
     if config.use_prior_preservation:
         print('generating class images for prior preservation')
@@ -55,21 +71,37 @@ def main(config: DictConfig):  # type: ignore
             # duplicate the class prompt * num class samples to generate class images
             images_to_generate = config.num_class_images - cur_class_images
             class_prompts = [config.dataset.class_prompt] * images_to_generate
+            # the prompt dataloader uses a distributed sampler, so each rank
+            # generates its own shard of the class images in parallel.
             prompt_dataloader = build_prompt_dataloader(
                 class_prompts, batch_size=config.train_device_batch_size)
             save_class_images = SaveClassImages(
                 class_data_root=config.dataset.class_data_root)
 
             model.num_images_per_prompt = 1  # set for prior preservation image generation
+            # match the training precision so fp16 frozen submodules run
+            # under autocast here as well
             trainer = Trainer(model=model,
                               eval_dataloader=prompt_dataloader,
-                              callbacks=save_class_images)
+                              callbacks=save_class_images,
+                              device=config.device,
+                              precision=config.get('precision'))
             # eval run will save images via the SaveClassImages callback
             trainer.eval()
             model.num_images_per_prompt = config.model.num_images_per_prompt
 
+        # wait until every rank has written its shard of class images before
+        # the training dataloader lists the class image directory.
+        if dist.get_world_size() > 1:
+            dist.barrier()
+
     # Train dataset
     print('Building dataloaders')
+    cache_latents = config.dataset.get('cache_latents', False)
+    if cache_latents and config.model.train_text_encoder:
+        raise ValueError(
+            'cache_latents requires train_text_encoder=False, cached text '
+            'embeddings would go stale as the text encoder trains.')
     train_dataloader = build_dreambooth_dataloader(
         instance_data_root=config.dataset.instance_data_root,
         instance_prompt=config.dataset.instance_prompt,
@@ -79,6 +111,8 @@ def main(config: DictConfig):  # type: ignore
         resolution=config.dataset.resolution,
         center_crop=config.dataset.center_crop,
         tokenizer=model.tokenizer,
+        vae=model.vae if cache_latents else None,
+        text_encoder=model.text_encoder if cache_latents else None,
         batch_size=config.train_device_batch_size,
         **config.dataset.get('dataloader_kwargs', {}))
 
@@ -115,6 +149,42 @@ def main(config: DictConfig):  # type: ignore
 
     # Create the Trainer!
     print('Building Trainer')
+    ddp_config = config.get('ddp')
+    if ddp_config and dist.get_world_size() > 1:
+        # Composer wraps the model in DistributedDataParallel internally but
+        # doesn't expose DDP's tuning knobs, inject them into the constructor
+        # it uses. Larger buckets overlap communication better on fast
+        # interconnects and gradient_as_bucket_view lets gradients alias
+        # bucket storage. static_graph defaults to off: it requires the same
+        # number of microbatches every step, which Composer's automatic
+        # microbatching (device_train_microbatch_size: auto) can change
+        # mid-training. Only enable it with a fixed microbatch size.
+        try:
+            from functools import partial
+
+            from composer.trainer import dist_strategy
+            from torch.nn.parallel import DistributedDataParallel
+            if not hasattr(dist_strategy, 'DistributedDataParallel'):
+                raise AttributeError(
+                    'composer.trainer.dist_strategy no longer wraps '
+                    'DistributedDataParallel')
+            dist_strategy.DistributedDataParallel = partial(  # type: ignore
+                DistributedDataParallel,
+                bucket_cap_mb=ddp_config.get('bucket_cap_mb', 25),
+                gradient_as_bucket_view=ddp_config.get(
+                    'gradient_as_bucket_view', True),
+                static_graph=ddp_config.get('static_graph', False))
+        except (ImportError, AttributeError) as e:
+            print(f'Could not configure DDP, using Composer defaults. {e}')
+    if dist.get_world_size() > 1:
+        # Composer's default ddp sync strategy already wraps all but the final
+        # microbatch of each batch in DDP no_sync, so the ~3.4GB of unet
+        # gradients are only all-reduced once per optimizer step.
+        print(
+            f'Training with {dist.get_world_size()} ranks, '
+            f"ddp_sync_strategy={config.get('ddp_sync_strategy') or 'auto'}, "
+            f"device_train_microbatch_size={config.get('device_train_microbatch_size')}"
+        )
 
     fsdp_config = None
     if config.use_fsdp:
@@ -149,6 +219,7 @@ def main(config: DictConfig):  # type: ignore
         device=config.device,
         precision=config.get('precision'),
         device_train_microbatch_size=config.get('device_train_microbatch_size'),
+        ddp_sync_strategy=config.get('ddp_sync_strategy'),
         seed=config.seed,
         fsdp_config=fsdp_config)
 
@@ -3,7 +3,10 @@
 
 """Stable Diffusion ComposerModel."""
 
+import math
+import os
 from functools import partial
+from pathlib import Path
 from typing import Optional
 
 import diffusers
@@ -17,6 +20,124 @@ from diffusers.utils.import_utils import is_xformers_available
 from torchmetrics import Metric, MetricCollection
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer, PretrainedConfig
+from transformers.models.clip.modeling_clip import CLIPAttention
+
+
+class _UNetExportWrapper(torch.nn.Module):
+    """Unwraps the unet's dict output for torch.onnx / torch.export."""
+
+    def __init__(self, unet: torch.nn.Module):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self.unet(sample,
+                         timestep,
+                         encoder_hidden_states,
+                         return_dict=False)[0]
+
+
+class _AOTUNet:
+    """Runs the unet as a shape-specialized AOTInductor artifact.
+
+    For a given eval configuration `generate` always calls the unet on the
+    same `(batch, channel, h, w)` shapes, so the graph can be exported and
+    compiled once, removing the python dispatch and guard overhead from the
+    50-step denoising loop. Requires PyTorch >= 2.2.
+    """
+
+    def __init__(self, unet: torch.nn.Module, sample: torch.Tensor,
+                 timestep: torch.Tensor, encoder_hidden_states: torch.Tensor):
+        import torch._export  # type: ignore
+        import torch._inductor  # type: ignore
+        sample = sample.contiguous()
+        encoder_hidden_states = encoder_hidden_states.contiguous()
+        self.shapes = (tuple(sample.shape), tuple(encoder_hidden_states.shape))
+        example_inputs = (sample, timestep, encoder_hidden_states)
+        exported = torch.export.export(_UNetExportWrapper(unet), example_inputs)
+        so_path = torch._inductor.aot_compile(exported.module(), example_inputs)
+        self.compiled = torch._export.aot_load(so_path, sample.device.type)
+
+    def __call__(self, sample: torch.Tensor, timestep: torch.Tensor,
+                 encoder_hidden_states: torch.Tensor):
+        return self.compiled(sample.contiguous(), timestep,
+                             encoder_hidden_states.contiguous())
+
+
+class _ORTUNet:
+    """Runs an exported unet through an ONNX Runtime CUDA session.
+
+    ORT ahead-of-time fuses the fixed-shape unet graph, which is noticeably
+    faster than eager PyTorch for the 50-step denoising loop. Tensors are
+    exchanged through `io_binding`, so no host round trips happen per step.
+    """
+
+    def __init__(self, unet: torch.nn.Module, sample: torch.Tensor,
+                 timestep: torch.Tensor, encoder_hidden_states: torch.Tensor):
+        import onnxruntime as ort  # type: ignore
+
+        export_dir = Path(
+            os.environ.get(
+                'MOSAICML_CACHE',
+                Path.home() /
+                '.cache')) / 'mosaicml_examples' / 'stable_diffusion_onnx'
+        export_dir.mkdir(parents=True, exist_ok=True)
+        onnx_path = str(export_dir / 'unet.onnx')
+        torch.onnx.export(
+            _UNetExportWrapper(unet),
+            (sample.contiguous(), timestep, encoder_hidden_states.contiguous()),
+            onnx_path,
+            input_names=['sample', 'timestep', 'encoder_hidden_states'],
+            output_names=['noise_pred'],
+            dynamic_axes={
+                'sample': {
+                    0: 'batch'
+                },
+                'encoder_hidden_states': {
+                    0: 'batch'
+                },
+                'noise_pred': {
+                    0: 'batch'
+                },
+            },
+            opset_version=17)
+        providers = [('CUDAExecutionProvider',
+                      {})] if sample.is_cuda else ['CPUExecutionProvider']
+        self.session = ort.InferenceSession(onnx_path, providers=providers)
+
+    @staticmethod
+    def _numpy_dtype(dtype: torch.dtype):
+        import numpy as np
+        return {
+            torch.float16: np.float16,
+            torch.float32: np.float32,
+            torch.int64: np.int64,
+        }[dtype]
+
+    def __call__(self, sample: torch.Tensor, timestep: torch.Tensor,
+                 encoder_hidden_states: torch.Tensor):
+        binding = self.session.io_binding()
+        output = torch.empty_like(sample).contiguous()
+        inputs = {
+            'sample': sample.contiguous(),
+            'timestep': timestep,
+            'encoder_hidden_states': encoder_hidden_states.contiguous(),
+        }
+        for name, tensor in inputs.items():
+            binding.bind_input(name,
+                               device_type=tensor.device.type,
+                               device_id=tensor.device.index or 0,
+                               element_type=self._numpy_dtype(tensor.dtype),
+                               shape=tuple(tensor.shape),
+                               buffer_ptr=tensor.data_ptr())
+        binding.bind_output('noise_pred',
+                            device_type=output.device.type,
+                            device_id=output.device.index or 0,
+                            element_type=self._numpy_dtype(output.dtype),
+                            shape=tuple(output.shape),
+                            buffer_ptr=output.data_ptr())
+        self.session.run_with_iobinding(binding)
+        return output
 
 
 class StableDiffusion(ComposerModel):
@@ -59,6 +180,16 @@ class StableDiffusion(ComposerModel):
             Default: `image_tensor`.
         caption_key (str): The name of the caption inputs in the dataloader batch.
             Default: `input_ids`.
+        inference_backend (str): `pytorch`, `ort`, or `aot`. `ort` exports the
+            unet to ONNX on the first `generate` call and runs the denoising
+            loop through ONNX Runtime; `aot` compiles a shape-specialized
+            AOTInductor artifact instead (PyTorch >= 2.2), falling back to
+            eager for unseen shapes. Both export frozen weights, so only use
+            them when the unet is not being trained (e.g. prior preservation
+            class image generation). Default: `pytorch`.
+        torch_compile (bool): Compile the fused noise-add -> unet -> target
+            training step with `torch.compile`. Requires PyTorch >= 2.0.
+            Default: `False`.
     """
 
     def __init__(
@@ -77,8 +208,20 @@ class StableDiffusion(ComposerModel):
             train_metrics: Optional[list] = None,
             val_metrics: Optional[list] = None,
             image_key: str = 'image_tensor',
-            caption_key: str = 'input_ids'):
+            caption_key: str = 'input_ids',
+            inference_backend: str = 'pytorch',
+            torch_compile: bool = False):
         super().__init__()
+        if inference_backend not in ['pytorch', 'ort', 'aot']:
+            raise ValueError(
+                'inference_backend must be "pytorch", "ort" or "aot"')
+        self.inference_backend = inference_backend
+        self._ort_unet = None
+        self._aot_unet = None
+        # scratch buffers reused across steps/calls by `_sample_noise` and
+        # `generate`, so cuRAND fills don't allocate a fresh tensor each time
+        self._noise_buffer = None
+        self._latents_buffer = None
         self.unet = unet
         self.vae = vae
         self.text_encoder = text_encoder
@@ -86,6 +229,18 @@ class StableDiffusion(ComposerModel):
         self.noise_scheduler = noise_scheduler
         self.inference_scheduler = inference_scheduler
 
+        # cache the forward diffusion tables as (non-persistent) buffers so
+        # they live on the training device and `add_noise`/`get_velocity`
+        # reduce to two gathers + pointwise math, instead of the scheduler
+        # re-casting and reshaping them every step.
+        alphas_cumprod = self.noise_scheduler.alphas_cumprod.float()
+        self.register_buffer('sqrt_alphas_cumprod',
+                             alphas_cumprod.sqrt(),
+                             persistent=False)
+        self.register_buffer('sqrt_one_minus_alphas_cumprod',
+                             (1.0 - alphas_cumprod).sqrt(),
+                             persistent=False)
+
         # let schedulers knows if we're predicting the noise residual or V
         if prediction_type:
             if prediction_type not in ['v_prediction', 'epsilon']:
@@ -96,9 +251,11 @@ class StableDiffusion(ComposerModel):
 
         # freeze vae during diffusion training
         self.vae.requires_grad_(False)
+        self.vae.eval()
         # freeze text_encoder during diffusion training
         if not train_text_encoder:
             self.text_encoder.requires_grad_(False)
+            self.text_encoder.eval()
 
         if not train_unet:
             self.unet.requires_grad_(False)
@@ -110,21 +267,79 @@ class StableDiffusion(ComposerModel):
         self.val_metrics = MetricCollection(
             val_metrics) if val_metrics else None
 
+        self.train_text_encoder = train_text_encoder
+
+        # the unconditional ('') prompt used for classifier free guidance is
+        # constant, tokenize it once. Its embedding is cached lazily on the
+        # first `generate` call when the text encoder is frozen.
+        self._uncond_input_ids = tokenizer(
+            [''],
+            padding='max_length',
+            max_length=tokenizer.model_max_length,
+            return_tensors='pt').input_ids
+        self._uncond_embeddings = None
+
         self.image_key = image_key
         self.caption_key = caption_key
         self.num_images_per_prompt = num_images_per_prompt
 
-    def forward(self, batch):
-        inputs, conditioning = batch[self.image_key], batch[self.caption_key]
+        self._denoise_fn = self._denoise
+        if torch_compile and hasattr(torch, 'compile'):
+            self._denoise_fn = torch.compile(self._denoise)
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        # keep the frozen submodules in eval mode (e.g. no dropout) when the
+        # trainer flips the whole model back to train
+        self.vae.eval()
+        if not self.train_text_encoder:
+            self.text_encoder.eval()
+        return self
+
+    def _sample_noise(self, like: torch.Tensor):
+        """Draws standard normal noise shaped like `like` into a reused buffer.
 
-        # Encode the images to the latent space
-        latents = self.vae.encode(
-            inputs)['latent_dist'].sample().data  # type: ignore
-        # Magical scaling number (See https://github.com/huggingface/diffusers/issues/437#issuecomment-1241827515)
-        latents *= 0.18215
+        The buffer is only valid until the next call, callers must consume it
+        (or clone) before sampling again. Reset on shape/device/dtype change.
+        """
+        if (self._noise_buffer is None or
+                self._noise_buffer.shape != like.shape or
+                self._noise_buffer.device != like.device or
+                self._noise_buffer.dtype != like.dtype):
+            self._noise_buffer = torch.empty_like(like)
+        return torch.randn(like.shape, out=self._noise_buffer)
 
-        # Encode the text. Assume that the text is already tokenized.
-        conditioning = self.text_encoder(conditioning)[0]  # (bs, 77, 768)
+    def forward(self, batch):
+        if 'latents_mean' in batch:
+            # latents and text embeddings were pre-encoded by the dataloader
+            # (see `CachedDreamBoothDataset`), sample from the stored latent
+            # distribution and skip the frozen vae/text encoder forwards.
+            latents = batch['latents_mean'] + torch.exp(
+                0.5 * batch['latents_logvar']) * self._sample_noise(
+                    batch['latents_mean'])
+            conditioning = batch['text_embeds']
+        else:
+            inputs, conditioning = batch[self.image_key], batch[
+                self.caption_key]
+
+            # Encode the images to the latent space. The vae is frozen, so
+            # inference_mode skips all autograd bookkeeping; clone the result
+            # since inference tensors can't re-enter the autograd graph.
+            with torch.inference_mode():
+                latents = self.vae.encode(
+                    inputs)['latent_dist'].sample().data  # type: ignore
+            latents = latents.clone()
+
+            # Encode the text. Assume that the text is already tokenized.
+            if self.train_text_encoder:
+                conditioning = self.text_encoder(conditioning)[
+                    0]  # (bs, 77, 768)
+            else:
+                with torch.inference_mode():
+                    conditioning = self.text_encoder(conditioning)[0]
+                conditioning = conditioning.clone()
+        # the latent scaling constant is folded into the vae convs,
+        # see `_fold_vae_scaling_factor`
 
         # Sample the diffusion timesteps
         timesteps = torch.randint(0,
@@ -132,17 +347,32 @@ class StableDiffusion(ComposerModel):
                                   (latents.shape[0],),
                                   device=latents.device)
         # Add noise to the inputs (forward diffusion)
-        noise = torch.randn_like(latents)
+        noise = self._sample_noise(latents)
 
-        noised_latents = self.noise_scheduler.add_noise(latents, noise,
-                                                        timesteps)
+        return self._denoise_fn(latents, noise, timesteps, conditioning)
+
+    def _denoise(self, latents: torch.Tensor, noise: torch.Tensor,
+                 timesteps: torch.Tensor, conditioning: torch.Tensor):
+        """Noise-add -> unet -> loss-target chain of the training step.
+
+        Grouped into one function so `torch.compile` can fuse the pointwise
+        prelude and target epilogue with the unet graph instead of streaming
+        the latents through HBM once per op.
+        """
+        sqrt_alpha_prod = self.sqrt_alphas_cumprod[timesteps].to(
+            latents.dtype)[:, None, None, None]
+        sqrt_one_minus_alpha_prod = self.sqrt_one_minus_alphas_cumprod[
+            timesteps].to(latents.dtype)[:, None, None, None]
+        noised_latents = (sqrt_alpha_prod * latents +
+                          sqrt_one_minus_alpha_prod * noise).contiguous(
+                              memory_format=torch.channels_last)
 
         # Get the target for loss depending on the prediction type
         if self.noise_scheduler.config.prediction_type == 'epsilon':
             target = noise
         elif self.noise_scheduler.config.prediction_type == 'v_prediction':
-            target = self.noise_scheduler.get_velocity(latents, noise,
-                                                       timesteps)
+            # inlined `noise_scheduler.get_velocity`
+            target = sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod * latents
         else:
             raise ValueError(
                 f'Unknown prediction type {self.noise_scheduler.config.prediction_type}'
@@ -202,8 +432,6 @@ class StableDiffusion(ComposerModel):
             seed (int): Random seed to use for generation. Set a seed for reproducible generation.
                 Default: `None`.
         """
-        if seed:
-            torch.manual_seed(seed)
         num_images_per_prompt = num_images_per_prompt if num_images_per_prompt else self.num_images_per_prompt
         batch_size = 1 if isinstance(prompt, str) else len(prompt)
 
@@ -221,64 +449,95 @@ class StableDiffusion(ComposerModel):
         width = width or sample_size * vae_scale_factor  # type: ignore
 
         device = self.vae.device
-        # tokenize and encode text prompt
+        generator = None
+        if seed:
+            # a device-local generator keeps seeded sampling off the global
+            # (cpu) rng state, so `torch.randn` below doesn't sync host<->device
+            generator = torch.Generator(device=device).manual_seed(seed)
+
+        # tokenize text prompt
         text_input = self.tokenizer(prompt,
                                     padding='max_length',
                                     max_length=self.tokenizer.model_max_length,
                                     truncation=True,
                                     return_tensors='pt')
-        text_embeddings = self.text_encoder(text_input.input_ids.to(device))[0]
-
-        # duplicate text embeddings for each generation per prompt
-        bs_embed, seq_len, _ = text_embeddings.shape
-        text_embeddings = text_embeddings.repeat(1, num_images_per_prompt, 1)
-        text_embeddings = text_embeddings.view(bs_embed * num_images_per_prompt,
-                                               seq_len, -1)
+        input_ids = text_input.input_ids
 
         # classifier free guidance + negative prompts
         # negative prompt is given in place of the unconditional input in classifier free guidance
         do_classifier_free_guidance = guidance_scale > 1.0
+        unconditional_embeddings = None
         if do_classifier_free_guidance:
-            unconditional_input = negative_prompt or ([''] * batch_size)
-
-            # tokenize + encode negative or uncoditional prompt
-            unconditional_input = self.tokenizer(
-                unconditional_input,
-                padding='max_length',
-                max_length=self.tokenizer.model_max_length,
-                return_tensors='pt')
-            unconditional_embeddings = self.text_encoder(
-                unconditional_input.input_ids.to(device))[0]
-
-            # duplicate unconditional embeddings if we want to generate multiple images per prompt
-            bs_embed, seq_len, _ = unconditional_embeddings.shape
-            unconditional_embeddings = unconditional_embeddings.repeat(
-                1, num_images_per_prompt, 1)
-            unconditional_embeddings = unconditional_embeddings.view(
-                bs_embed * num_images_per_prompt, seq_len, -1)
-
-            # concat uncond + prompt
+            if negative_prompt is None and not self.train_text_encoder:
+                # the '' embedding never changes while the text encoder is
+                # frozen, encode it once and reuse it across calls.
+                if self._uncond_embeddings is None:
+                    self._uncond_embeddings = self.text_encoder(
+                        self._uncond_input_ids.to(device))[0]
+                unconditional_embeddings = self._uncond_embeddings.to(
+                    device).expand(batch_size, -1, -1)
+            else:
+                unconditional_input = negative_prompt or ([''] * batch_size)
+
+                # tokenize negative or uncoditional prompt, stacked in front of
+                # the prompt so both are encoded in one text encoder forward,
+                # mirroring the CFG batching done for the unet below.
+                unconditional_input = self.tokenizer(
+                    unconditional_input,
+                    padding='max_length',
+                    max_length=self.tokenizer.model_max_length,
+                    return_tensors='pt')
+                input_ids = torch.cat(
+                    [unconditional_input.input_ids, input_ids])
+
+        text_embeddings = self.text_encoder(input_ids.to(device))[0]
+        if unconditional_embeddings is not None:
             text_embeddings = torch.cat(
                 [unconditional_embeddings, text_embeddings])
 
-        # prepare for diffusion generation process
-        latents = torch.randn(
-            (
-                batch_size * num_images_per_prompt,
-                self.unet.in_channels,  # type: ignore
-                height // vae_scale_factor,
-                width // vae_scale_factor),
-            device=device,  # type: ignore
-            dtype=text_embeddings.dtype)  # type: ignore
+        # duplicate text embeddings for each generation per prompt, this keeps
+        # the [unconditional, prompt] block ordering intact.
+        bs_embed, seq_len, _ = text_embeddings.shape
+        text_embeddings = text_embeddings.repeat(1, num_images_per_prompt, 1)
+        text_embeddings = text_embeddings.view(bs_embed * num_images_per_prompt,
+                                               seq_len, -1)
+
+        # prepare for diffusion generation process, the initial noise is drawn
+        # into a buffer reused across calls of the same shape
+        latents_shape = (
+            batch_size * num_images_per_prompt,
+            self.unet.in_channels,  # type: ignore
+            height // vae_scale_factor,
+            width // vae_scale_factor)
+        if (self._latents_buffer is None or
+                self._latents_buffer.shape != latents_shape or
+                self._latents_buffer.device != device or
+                self._latents_buffer.dtype != text_embeddings.dtype):
+            self._latents_buffer = torch.empty(
+                latents_shape,
+                device=device,  # type: ignore
+                dtype=text_embeddings.dtype)  # type: ignore
+        latents = torch.randn(latents_shape,
+                              generator=generator,
+                              out=self._latents_buffer)
         self.inference_scheduler.set_timesteps(num_inference_steps)
+        # pin the scheduler state to the device so per-step indexing inside
+        # `scale_model_input`/`step` doesn't bounce through the host
+        timesteps = self.inference_scheduler.timesteps.to(device)
+        self.inference_scheduler.timesteps = timesteps
+        for attr in ['sigmas', 'alphas_cumprod', 'final_alpha_cumprod']:
+            value = getattr(self.inference_scheduler, attr, None)
+            if torch.is_tensor(value):
+                setattr(self.inference_scheduler, attr, value.to(device))
 
         # scale the initial noise by the standard deviation required by the scheduler
-        latents = latents * self.inference_scheduler.init_noise_sigma
+        latents = (latents *
+                   self.inference_scheduler.init_noise_sigma).contiguous(
+                       memory_format=torch.channels_last)
 
         # backward diffusion process
-        # self.inference_scheduler.timesteps = self.inference_scheduler.timesteps.to(dtype=text_embeddings.dtype) # for mps
-        for t in tqdm(self.inference_scheduler.timesteps,
-                      disable=disable_progress_bar):
+        # timesteps = timesteps.to(dtype=text_embeddings.dtype) # for mps
+        for t in tqdm(timesteps, disable=disable_progress_bar):
             # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
             if do_classifier_free_guidance:
                 latent_model_input = torch.cat([latents] * 2)
@@ -289,27 +548,60 @@ class StableDiffusion(ComposerModel):
                 latent_model_input, t)
 
             # predict the noise residual
-            noise_pred = self.unet(latent_model_input,
-                                   t,
-                                   encoder_hidden_states=text_embeddings).sample
+            noise_pred = self._unet_forward(latent_model_input, t,
+                                            text_embeddings)
 
             if do_classifier_free_guidance:
-                # perform guidance
+                # perform guidance, uncond + scale * (text - uncond) computed
+                # in place on the (non-overlapping) chunk views of the unet
+                # output so no intermediate tensors are materialized.
                 noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (
-                    noise_pred_text - noise_pred_uncond)
+                noise_pred = noise_pred_uncond.add_(
+                    noise_pred_text.sub_(noise_pred_uncond),
+                    alpha=guidance_scale)
 
             # compute the previous noisy sample x_t -> x_t-1
             latents = self.inference_scheduler.step(noise_pred, t,
                                                     latents).prev_sample
 
         # We now use the vae to decode the generated latents back into the image.
-        # scale and decode the image latents with vae
-        latents = 1 / 0.18215 * latents  # type: ignore
+        # the 1 / 0.18215 unscaling is folded into the vae decoder convs,
+        # see `_fold_vae_scaling_factor`
         image = self.vae.decode(latents).sample  # type: ignore
         image = (image / 2 + 0.5).clamp(0, 1)
         return image.detach()  # (batch*num_images_per_prompt, channel, h, w)
 
+    def _unet_forward(self, latents: torch.Tensor, t,
+                      text_embeddings: torch.Tensor):
+        """Single denoising step, routed through the inference backend."""
+        if self.inference_backend == 'ort':
+            if not torch.is_tensor(t):
+                t = torch.tensor(t, dtype=torch.int64, device=latents.device)
+            if self._ort_unet is None:
+                try:
+                    self._ort_unet = _ORTUNet(self.unet, latents, t,
+                                              text_embeddings)
+                except Exception as e:
+                    print(f'Falling back to the pytorch backend, {e}.')
+                    self.inference_backend = 'pytorch'
+            if self._ort_unet is not None:
+                return self._ort_unet(latents, t, text_embeddings)
+        elif self.inference_backend == 'aot':
+            if not torch.is_tensor(t):
+                t = torch.tensor(t, dtype=torch.int64, device=latents.device)
+            if self._aot_unet is None:
+                try:
+                    self._aot_unet = _AOTUNet(self.unet, latents, t,
+                                              text_embeddings)
+                except Exception as e:
+                    print(f'Falling back to the pytorch backend, {e}.')
+                    self.inference_backend = 'pytorch'
+            if self._aot_unet is not None and self._aot_unet.shapes == (tuple(
+                    latents.shape), tuple(text_embeddings.shape)):
+                return self._aot_unet(latents, t, text_embeddings)
+        return self.unet(latents, t,
+                         encoder_hidden_states=text_embeddings).sample
+
     def get_metrics(self, is_train: bool = False):
         if is_train:
             metrics = self.train_metrics
@@ -348,6 +640,134 @@ def prior_preservation_loss(model_pred: torch.Tensor,
     return F.mse_loss(model_pred.float(), target.float(), reduction='mean')
 
 
+def _fold_vae_scaling_factor(vae: torch.nn.Module,
+                             scaling_factor: float = 0.18215):
+    """Folds the latent scaling constant into the vae's boundary convs.
+
+    The magical scaling number (see
+    https://github.com/huggingface/diffusers/issues/437#issuecomment-1241827515)
+    used to be applied as an elementwise pass over the full latent tensor on
+    every training step (`latents *= 0.18215`) and every decode
+    (`latents * 1 / 0.18215`). Both boundary convs are linear, so the constant
+    can be absorbed into their weights once at load time instead: scale the
+    mean channels of `quant_conv` by the constant, shift its logvar channels
+    by 2*log(constant) (scaling a gaussian scales its mean and std, i.e.
+    shifts the logvar), and divide the `post_quant_conv` weights by the
+    constant to undo the scaling on decode.
+    """
+    with torch.no_grad():
+        latent_channels = vae.quant_conv.weight.shape[0] // 2
+        vae.quant_conv.weight[:latent_channels] *= scaling_factor
+        vae.quant_conv.bias[:latent_channels] *= scaling_factor
+        vae.quant_conv.bias[latent_channels:] += 2.0 * math.log(scaling_factor)
+        vae.post_quant_conv.weight /= scaling_factor
+
+
+def _fused_self_attention_forward(self,
+                                  hidden_states,
+                                  encoder_hidden_states=None,
+                                  attention_mask=None,
+                                  **cross_attention_kwargs):
+    """Self-attention forward with the q/k/v projections batched as one GEMM.
+
+    The projection weights are concatenated per call, so gradients still reach
+    the original parameters and checkpoints keep their layout, while the input
+    activations are only read from HBM once instead of three times.
+    """
+    if (encoder_hidden_states is not None or attention_mask is not None or
+            cross_attention_kwargs):
+        # key/value come from the conditioning, nothing to batch
+        return self._unfused_forward(
+            hidden_states,
+            encoder_hidden_states=encoder_hidden_states,
+            attention_mask=attention_mask,
+            **cross_attention_kwargs)
+    batch, seq_len, _ = hidden_states.shape
+    weight = torch.cat([self.to_q.weight, self.to_k.weight, self.to_v.weight])
+    query, key, value = F.linear(hidden_states, weight).chunk(3, dim=-1)
+    head_dim = query.shape[-1] // self.heads
+    query, key, value = (t.view(batch, seq_len, self.heads,
+                                head_dim).transpose(1, 2)
+                         for t in (query, key, value))
+    if hasattr(F, 'scaled_dot_product_attention'):
+        hidden_states = F.scaled_dot_product_attention(query, key, value)
+    else:
+        scale = getattr(self, 'scale', head_dim**-0.5)
+        attention_probs = torch.softmax(
+            torch.matmul(query, key.transpose(-1, -2)) * scale, dim=-1)
+        hidden_states = torch.matmul(attention_probs, value)
+    hidden_states = hidden_states.transpose(1,
+                                            2).reshape(batch, seq_len,
+                                                       self.heads * head_dim)
+    # output projection + dropout
+    hidden_states = self.to_out[0](hidden_states)
+    return self.to_out[1](hidden_states)
+
+
+def _fuse_qkv_projections(model: torch.nn.Module):
+    """Patches self-attention blocks to run q/k/v as a single projection.
+
+    Fallback for diffusers versions that predate `fuse_qkv_projections()`.
+    Only plain self-attention qualifies (`to_q`/`to_k`/`to_v` of equal shape
+    over the same input, no biases, no extra norm or added kv projections);
+    everything else keeps its original forward.
+    """
+    for module in model.modules():
+        projections = [
+            getattr(module, name, None) for name in ('to_q', 'to_k', 'to_v')
+        ]
+        if not all(isinstance(proj, torch.nn.Linear) for proj in projections):
+            continue
+        if not (hasattr(module, 'heads') and hasattr(module, 'to_out')):
+            continue
+        if any(proj.bias is not None for proj in projections):
+            continue
+        if any(proj.weight.shape != projections[0].weight.shape
+               for proj in projections):
+            continue
+        if (getattr(module, 'group_norm', None) is not None or
+                getattr(module, 'add_k_proj', None) is not None):
+            continue
+        module._unfused_forward = module.forward
+        module.forward = _fused_self_attention_forward.__get__(module)
+
+
+def _clip_sdpa_forward(self,
+                       hidden_states,
+                       attention_mask=None,
+                       causal_attention_mask=None,
+                       output_attentions=False):
+    """`CLIPAttention.forward` rewritten around F.scaled_dot_product_attention.
+
+    PyTorch >= 2.0 dispatches SDPA to flash/memory-efficient kernels, which cuts
+    HBM traffic vs. the eager softmax(QK^T)V implementation in transformers.
+    """
+    if output_attentions:
+        # SDPA cannot return attention weights, use the eager path instead.
+        return CLIPAttention.forward(self, hidden_states, attention_mask,
+                                     causal_attention_mask, output_attentions)
+    bsz, tgt_len, embed_dim = hidden_states.size()
+    query = self.q_proj(hidden_states)
+    key = self.k_proj(hidden_states)
+    value = self.v_proj(hidden_states)
+    query, key, value = (t.view(bsz, tgt_len, self.num_heads,
+                                self.head_dim).transpose(1, 2)
+                         for t in (query, key, value))
+
+    attn_mask = causal_attention_mask
+    if attention_mask is not None:
+        attn_mask = attention_mask if attn_mask is None else attn_mask + attention_mask
+
+    attn_output = F.scaled_dot_product_attention(
+        query,
+        key,
+        value,
+        attn_mask=attn_mask,
+        dropout_p=self.dropout if self.training else 0.0)
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, embed_dim)
+    return self.out_proj(attn_output), None
+
+
 def build_stable_diffusion_model(model_name_or_path: str,
                                  train_text_encoder: bool = False,
                                  train_unet: bool = True,
@@ -355,7 +775,10 @@ def build_stable_diffusion_model(model_name_or_path: str,
                                  image_key: str = 'image_tensor',
                                  caption_key: str = 'input_ids',
                                  pretrained: bool = True,
-                                 prior_loss_weight: float = 1.0):
+                                 prior_loss_weight: float = 1.0,
+                                 torch_compile: bool = False,
+                                 fp16_frozen_weights: bool = False,
+                                 inference_backend: str = 'pytorch'):
     """Builds a Stable Diffusion ComposerModel.
 
     Args:
@@ -371,6 +794,15 @@ def build_stable_diffusion_model(model_name_or_path: str,
             Default: `input_ids`.
         pretrained (bool): If true, download model weights. Default: `False`.
         prior_loss_weight (float): prior preservation loss weight. Default: `1.0`.
+        torch_compile (bool): Whether to wrap the unet and vae decoder with
+            `torch.compile`. Requires PyTorch >= 2.0. Default: `False`.
+        fp16_frozen_weights (bool): Cast the frozen submodules (the vae, and
+            the text encoder when `train_text_encoder=False`) to fp16. Frozen
+            modules keep no optimizer state, so halving their weight bytes
+            halves their HBM traffic with no effect on training. Requires
+            `precision: amp_fp16`. Default: `False`.
+        inference_backend (str): `pytorch`, `ort`, or `aot`, see
+            `StableDiffusion`. Default: `pytorch`.
     """
     if not pretrained:
         unet = UNet2DConditionModel(**PretrainedConfig.get_config_dict(
@@ -393,11 +825,77 @@ def build_stable_diffusion_model(model_name_or_path: str,
         text_encoder = CLIPTextModel.from_pretrained(model_name_or_path,
                                                      subfolder='text_encoder')
 
+    # absorb the 0.18215 latent scaling constant into the vae's boundary
+    # convs so no elementwise scaling passes are needed at runtime.
+    _fold_vae_scaling_factor(vae)
+
+    # the unet and vae are convolutional, NHWC layout keeps cudnn from
+    # inserting layout transforms around the conv kernels on tensor cores.
+    # the text encoder has no convs and stays in the default layout.
+    unet = unet.to(memory_format=torch.channels_last)
+    vae = vae.to(memory_format=torch.channels_last)
+
+    xformers_enabled = False
     if is_xformers_available():
         try:
             unet.enable_xformers_memory_efficient_attention()
+            # the vae encoder runs every training step and the decoder on every
+            # `generate` call, both benefit from the same fused kernels.
+            vae.enable_xformers_memory_efficient_attention()
+            xformers_enabled = True
         except Exception as e:
             print(f'Building without xformers, {e}.')
+    if not xformers_enabled and hasattr(F, 'scaled_dot_product_attention'):
+        # no xformers installed, fall back to PyTorch >= 2.0's SDPA, which
+        # dispatches to flash/memory-efficient kernels on its own.
+        try:
+            from diffusers.models.attention_processor import \
+                AttnProcessor2_0  # type: ignore
+            unet.set_attn_processor(AttnProcessor2_0())
+            vae.set_attn_processor(AttnProcessor2_0())
+        except (ImportError, AttributeError) as e:
+            print(f'Building without SDPA attention, {e}.')
+    if not xformers_enabled:
+        # merge the separate q/k/v linears into one 3x-wide GEMM so the
+        # attention input activations are only read once. skipped when the
+        # xformers processors were installed above: newer diffusers'
+        # fuse_qkv_projections() would replace them with its own fused
+        # processors.
+        if hasattr(unet, 'fuse_qkv_projections'):
+            try:
+                unet.fuse_qkv_projections()
+                vae.fuse_qkv_projections()
+            except Exception as e:
+                print(f'Building without fused qkv projections, {e}.')
+        else:
+            # the pinned diffusers predates fuse_qkv_projections(), patch the
+            # unet's self-attention blocks directly.
+            _fuse_qkv_projections(unet)
+    if fp16_frozen_weights:
+        # autocast still keeps fp32 masters and inserts casts; the frozen
+        # submodules can live permanently in fp16 instead.
+        vae = vae.half()
+        if not train_text_encoder:
+            text_encoder = text_encoder.half()
+    if hasattr(F, 'scaled_dot_product_attention'):
+        # CLIP self-attention isn't covered by diffusers' xformers hook, route
+        # it through SDPA instead (PyTorch >= 2.0).
+        for module in text_encoder.modules():
+            if isinstance(module, CLIPAttention):
+                module.forward = _clip_sdpa_forward.__get__(module)
+    if torch_compile:
+        if hasattr(torch, 'compile'):
+            # the unet runs once per training step and `num_inference_steps`
+            # times per `generate` call, always on fixed shapes, so
+            # `reduce-overhead` mode can reuse CUDA graphs across iterations.
+            # the first call after compilation acts as the warm-up.
+            unet = torch.compile(unet,
+                                 mode='reduce-overhead',
+                                 fullgraph=False,
+                                 dynamic=False)
+            vae.decode = torch.compile(vae.decode, mode='reduce-overhead')
+        else:
+            print('torch.compile requires PyTorch >= 2.0, building without it.')
     noise_scheduler = DDPMScheduler.from_pretrained(model_name_or_path,
                                                     subfolder='scheduler')
     inference_scheduler = DDIMScheduler.from_pretrained(model_name_or_path,
@@ -416,5 +914,7 @@ def build_stable_diffusion_model(model_name_or_path: str,
         num_images_per_prompt=num_images_per_prompt,
         image_key=image_key,
         caption_key=caption_key,
+        inference_backend=inference_backend,
+        torch_compile=torch_compile,
         loss_fn=partial(prior_preservation_loss,
                         prior_loss_weight=prior_loss_weight))  # type: ignore
@@ -1,9 +1,17 @@
 # Copyright 2022 MosaicML Examples authors
 # SPDX-License-Identifier: Apache-2.0
 
+import copy
+from pathlib import Path
+
 import pytest
 import torch
-from model import build_stable_diffusion_model
+from data import (CachedDreamBoothDataset, DreamBoothDataset,
+                  cached_dreambooth_collate_fn)
+from diffusers import AutoencoderKL
+from model import _fold_vae_scaling_factor, build_stable_diffusion_model
+from PIL import Image
+from torchvision import transforms
 
 
 @pytest.mark.parametrize(
@@ -31,3 +39,125 @@ def test_model_builder(model_name: str):
     )  # model.forward generates the unet output noise or v_pred target.
     assert output.shape == latent.shape
     assert target.shape == latent.shape
+
+
+def test_fold_vae_scaling_factor():
+    # folding the latent scaling constant into the vae's boundary convs must
+    # match scaling the latents explicitly, including the logvar shift that
+    # keeps the sampled (not just the mean) latents scaled.
+    torch.manual_seed(0)
+    scaling_factor = 0.18215
+    vae = AutoencoderKL(block_out_channels=(32,),
+                        latent_channels=4,
+                        sample_size=32)
+    vae.eval()
+    folded = copy.deepcopy(vae)
+    _fold_vae_scaling_factor(folded, scaling_factor=scaling_factor)
+
+    image = torch.randn(1, 3, 32, 32)
+    with torch.no_grad():
+        ref_dist = vae.encode(image)['latent_dist']
+        folded_dist = folded.encode(image)['latent_dist']
+    assert torch.allclose(folded_dist.mean,
+                          ref_dist.mean * scaling_factor,
+                          atol=1e-5)
+    assert torch.allclose(folded_dist.std,
+                          ref_dist.std * scaling_factor,
+                          atol=1e-5)
+
+    latents = folded_dist.mean
+    with torch.no_grad():
+        ref_image = vae.decode(latents / scaling_factor)['sample']
+        folded_image = folded.decode(latents)['sample']
+    assert torch.allclose(folded_image, ref_image, atol=1e-5)
+
+
+def _make_cached_example(fill: float):
+    return {
+        'instance_latents_mean': torch.full((4, 1, 1), fill),
+        'instance_latents_logvar': torch.full((4, 1, 1), fill),
+        'instance_text_embeds': torch.full((77, 8), fill),
+        'class_latents_mean': torch.full((4, 1, 1), -fill),
+        'class_latents_logvar': torch.full((4, 1, 1), -fill),
+        'class_text_embeds': torch.full((77, 8), -fill),
+    }
+
+
+def test_cached_collate_fn_ordering():
+    # `prior_preservation_loss` chunks the batch into [instance, class]
+    # halves, so the cached collate must keep all instance rows first.
+    examples = [_make_cached_example(1.0), _make_cached_example(2.0)]
+
+    batch = cached_dreambooth_collate_fn(examples, use_prior_preservation=False)
+    assert set(batch) == {'latents_mean', 'latents_logvar', 'text_embeds'}
+    assert batch['latents_mean'].shape == (2, 4, 1, 1)
+    assert torch.equal(batch['latents_mean'][:, 0, 0, 0],
+                       torch.tensor([1.0, 2.0]))
+
+    batch = cached_dreambooth_collate_fn(examples, use_prior_preservation=True)
+    assert batch['latents_mean'].shape == (4, 4, 1, 1)
+    assert torch.equal(batch['latents_mean'][:, 0, 0, 0],
+                       torch.tensor([1.0, 2.0, -1.0, -2.0]))
+    assert torch.equal(batch['text_embeds'][:, 0, 0],
+                       torch.tensor([1.0, 2.0, -1.0, -2.0]))
+
+
+@pytest.mark.parametrize('use_prior_preservation', [False, True])
+def test_cached_dataset_forward(tmp_path: Path, use_prior_preservation: bool):
+    model = build_stable_diffusion_model('CompVis/stable-diffusion-v1-4',
+                                         pretrained=False)
+    resolution = 8
+    image_transforms = transforms.Compose([
+        transforms.Resize(resolution),
+        transforms.CenterCrop(resolution),
+        transforms.ToTensor(),
+        transforms.Normalize([0.5], [0.5]),
+    ])
+    class_data_root = None
+    class_prompt = None
+    if use_prior_preservation:
+        class_data_root = tmp_path / 'class_data'
+        class_data_root.mkdir()
+        for i in range(2):
+            Image.new('RGB', (resolution, resolution),
+                      color=(i, 0, 0)).save(class_data_root / f'{i}.jpg')
+        class_prompt = 'a photo of dog'
+    dataset = DreamBoothDataset(
+        instance_data_root=str(
+            Path(__file__).parent.parent / 'data' / 'instance_data'),
+        instance_prompt='a photo of sks dog',
+        tokenizer=model.tokenizer,
+        class_prompt=class_prompt,
+        class_data_root=str(class_data_root) if class_data_root else None,
+        image_transforms=image_transforms)
+    cached = CachedDreamBoothDataset(dataset,
+                                     vae=model.vae,
+                                     text_encoder=model.text_encoder)
+
+    assert len(cached) == len(dataset)
+    example = cached[0]
+    expected_keys = {
+        'instance_latents_mean', 'instance_latents_logvar',
+        'instance_text_embeds'
+    }
+    if use_prior_preservation:
+        expected_keys |= {
+            'class_latents_mean', 'class_latents_logvar', 'class_text_embeds'
+        }
+    assert set(example) == expected_keys
+    latent_shape = (4, resolution // 8, resolution // 8)
+    embed_shape = (model.tokenizer.model_max_length,
+                   model.text_encoder.config.hidden_size)
+    for prefix in ('instance',
+                   'class') if use_prior_preservation else ('instance',):
+        assert example[f'{prefix}_latents_mean'].shape == latent_shape
+        assert example[f'{prefix}_latents_logvar'].shape == latent_shape
+        assert example[f'{prefix}_text_embeds'].shape == embed_shape
+
+    batch = cached_dreambooth_collate_fn(
+        [cached[0], cached[1]], use_prior_preservation=use_prior_preservation)
+    output, target = model(batch)
+    num_samples = 4 if use_prior_preservation else 2
+    # same shapes the uncached image batch produces
+    assert output.shape == (num_samples,) + latent_shape
+    assert target.shape == (num_samples,) + latent_shape